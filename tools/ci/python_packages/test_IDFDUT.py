@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import importlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # type: ignore
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+# ttfw_idf re-exports the IDFDUT class under the module's name
+idf_dut = importlib.import_module('ttfw_idf.IDFDUT')
+
+
+def _make_dut(port='/dev/ttyUSB0'):
+    # bypass __init__, it would open the port
+    dut = idf_dut.ESP32DUT.__new__(idf_dut.ESP32DUT)
+    dut.port = port
+    dut.secure_boot_en = False
+    dut._esptool_session = False
+    dut._esp_stub = None
+    dut.app = mock.MagicMock()
+    dut.app.flash_settings = {'flash_size': '2MB', 'flash_mode': 'dio', 'flash_freq': '40m'}
+    return dut
+
+
+class TestFlashBaudRates(unittest.TestCase):
+    def setUp(self):
+        idf_dut.IDFDUT._baud_cache.clear()
+        self.dut = _make_dut()
+
+    def test_default(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(self.dut._get_flash_baud_rates(), [921600, 460800, 115200])
+
+    def test_espbaud_and_cache_first(self):
+        idf_dut.IDFDUT._baud_cache['/dev/ttyUSB0'] = 460800
+        with mock.patch.dict(os.environ, {'ESPBAUD': '2000000'}):
+            self.assertEqual(self.dut._get_flash_baud_rates(), [2000000, 460800, 921600, 115200])
+
+    def test_cache_is_per_port(self):
+        idf_dut.IDFDUT._baud_cache['/dev/ttyUSB1'] = 460800
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(self.dut._get_flash_baud_rates(), [921600, 460800, 115200])
+
+    def test_no_duplicates(self):
+        idf_dut.IDFDUT._baud_cache['/dev/ttyUSB0'] = 921600
+        with mock.patch.dict(os.environ, {'ESPBAUD': '921600'}):
+            self.assertEqual(self.dut._get_flash_baud_rates(), [921600, 460800, 115200])
+
+    def test_invalid_espbaud(self):
+        with mock.patch.dict(os.environ, {'ESPBAUD': 'fast'}):
+            with self.assertRaisesRegex(ValueError, 'ESPBAUD'):
+                self.dut._get_flash_baud_rates()
+
+
+class TestWriteFlashData(unittest.TestCase):
+    def setUp(self):
+        idf_dut.IDFDUT._baud_cache.clear()
+        self.dut = _make_dut()
+        self.write_flash_data = idf_dut.IDFDUT.write_flash_data.__wrapped__
+        patcher = mock.patch.dict(os.environ, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(idf_dut.esptool, 'detect_flash_size')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_falls_back_when_round_trip_fails(self):
+        esp = mock.MagicMock()
+        esp.flash_id.side_effect = RuntimeError('no reply at 921600')
+        new_esp = mock.MagicMock()
+        self.dut._reconnect_esptool = mock.MagicMock(return_value=new_esp)
+        with mock.patch.object(idf_dut.esptool, 'write_flash') as write_flash:
+            self.write_flash_data(self.dut, esp, [(0x10000, io.BytesIO(b'app'))])
+        esp.change_baud.assert_called_once_with(921600)
+        new_esp.change_baud.assert_called_once_with(460800)
+        self.assertIs(write_flash.call_args[0][0], new_esp)
+        self.assertEqual(idf_dut.IDFDUT._baud_cache['/dev/ttyUSB0'], 460800)
+
+    def test_write_error_not_retried(self):
+        esp = mock.MagicMock()
+        self.dut._reconnect_esptool = mock.MagicMock()
+        with mock.patch.object(idf_dut.esptool, 'write_flash', side_effect=RuntimeError('write failed')) as write_flash:
+            with self.assertRaises(RuntimeError):
+                self.write_flash_data(self.dut, esp, [(0x10000, io.BytesIO(b'app'))])
+        self.assertEqual(write_flash.call_count, 1)
+        self.dut._reconnect_esptool.assert_not_called()
+        self.assertNotIn('/dev/ttyUSB0', idf_dut.IDFDUT._baud_cache)
+        # esptool's zlib module is always restored
+        self.assertIs(idf_dut.esptool.zlib, zlib)
+
+    def test_all_baud_rates_fail(self):
+        esp = mock.MagicMock()
+        esp.flash_id.side_effect = RuntimeError('no reply')
+        self.dut._reconnect_esptool = mock.MagicMock(return_value=esp)
+        with mock.patch.object(idf_dut.esptool, 'write_flash') as write_flash:
+            with self.assertRaises(RuntimeError):
+                self.write_flash_data(self.dut, esp, [(0x10000, io.BytesIO(b'app'))])
+        write_flash.assert_not_called()
+
+
+class TestPrecompressedZlib(unittest.TestCase):
+    def test_hit_and_fallback(self):
+        app = b'\x01\x02' * 1000 + b'\x03'
+        files = [(0x10000, io.BytesIO(app)), (0x9000, io.BytesIO(b'\xff' * 0x6000))]
+        precompressed = idf_dut._PrecompressedZlib(files)
+        try:
+            # files are rewound for esptool
+            self.assertEqual([f.tell() for (_, f) in files], [0, 0])
+            # esptool pads images to 4 bytes before compressing
+            padded = app + b'\xff' * 3
+            for future in precompressed._futures:
+                future.result()
+            with mock.patch.object(idf_dut.zlib, 'compress', wraps=zlib.compress) as compress:
+                self.assertEqual(zlib.decompress(precompressed.compress(padded, 9)), padded)
+                self.assertEqual(zlib.decompress(precompressed.compress(b'\xff' * 0x6000, 9)), b'\xff' * 0x6000)
+                compress.assert_not_called()
+                # e.g. bootloader with a header updated by esptool
+                self.assertEqual(zlib.decompress(precompressed.compress(b'other', 9)), b'other')
+                compress.assert_called_once_with(b'other', 9)
+            # everything else is taken from zlib
+            self.assertIs(precompressed.decompressobj, zlib.decompressobj)
+        finally:
+            precompressed.close()
+
+
+class TestListAvailablePorts(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.ports = []
+        for name in ['ttyUSB0', 'ttyUSB1']:
+            path = os.path.join(self.tmp_dir, name)
+            open(path, 'w').close()
+            self.ports.append(path)
+
+        idf_dut.IDFDUT.invalidate_port_cache()
+        self.addCleanup(idf_dut.IDFDUT.invalidate_port_cache)
+        for patcher in [mock.patch.object(idf_dut, '_PORT_GLOBS', [os.path.join(self.tmp_dir, 'tty*')]),
+                        mock.patch.object(idf_dut.IDFDUT, 'PORT_PATTERN', re.compile(r'tty(USB|ACM)')),
+                        mock.patch.object(idf_dut.glob, 'glob', return_value=self.ports)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def list_ports(self, espport=None):
+        env = {'ESPPORT': espport} if espport else {}
+        with mock.patch.dict(os.environ, env, clear=True):
+            return list(idf_dut.IDFDUT.list_available_ports())
+
+    def test_no_espport(self):
+        self.assertEqual(self.list_ports(), self.ports)
+
+    def test_espport_first(self):
+        self.assertEqual(self.list_ports(self.ports[1]), [self.ports[1], self.ports[0]])
+
+    def test_espport_symlink_listed_once(self):
+        link = os.path.join(self.tmp_dir, 'usb-Silicon_Labs_CP2102-if00-port0')
+        os.symlink(self.ports[0], link)
+        self.assertEqual(self.list_ports(link), [link, self.ports[1]])
+
+    def test_espport_not_enumerated_lazily(self):
+        ports = idf_dut.IDFDUT.list_available_ports
+        with mock.patch.dict(os.environ, {'ESPPORT': self.ports[0]}):
+            self.assertEqual(next(iter(ports())), self.ports[0])
+        idf_dut.glob.glob.assert_not_called()
+
+    def test_missing_espport(self):
+        self.assertEqual(self.list_ports(os.path.join(self.tmp_dir, 'ttyUSB9')), self.ports)
+
+    def test_port_cache(self):
+        self.list_ports()
+        self.list_ports()
+        self.assertEqual(idf_dut.glob.glob.call_count, 1)
+        idf_dut.IDFDUT.invalidate_port_cache()
+        self.list_ports()
+        self.assertEqual(idf_dut.glob.glob.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -340,8 +340,9 @@ class BaseDUT(object):
         list all available ports.
 
         subclass (port) must overwrite this method.
+        Ports may be enumerated lazily, callers should only iterate over the result.
 
-        :return: list of available comports
+        :return: iterable of available comports
         """
         pass
 
@@ -798,4 +799,5 @@ class SerialDUT(BaseDUT):
 
     @classmethod
     def list_available_ports(cls):
-        return [x.device for x in list_ports.comports()]
+        for x in list_ports.comports():
+            yield x.device
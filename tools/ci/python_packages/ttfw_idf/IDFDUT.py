@@ -3,19 +3,31 @@
 
 """ DUT for IDF applications """
 import collections
+import concurrent.futures
+import contextlib
 import functools
+import glob
+import hashlib
 import io
+import multiprocessing
 import os
 import os.path
 import re
+import struct
 import subprocess
 import sys
 import tempfile
 import time
+import zlib
 
 import pexpect
 import serial
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    pass
+
 # python2 and python3 queue package name is different
 try:
     import Queue as _queue
@@ -104,37 +116,60 @@ class IDFRecvThread(DUT.RecvThread):
     CHECK_FUNCTIONS = [collect_performance, detect_exception, detect_backtrace]
 
 
+# IOSSDATALAT = _IOW('T', 0, unsigned long) in IOKit/serial/ioss.h
+_IOSSDATALAT = 0x80085400
+
+
+def _set_low_latency(port_inst):
+    """
+    Best effort to make the USB serial adapter deliver received data immediately.
+    Adapters like FTDI buffer it for 16ms by default, which is added to every esptool command.
+    """
+    try:
+        if sys.platform.startswith('linux'):
+            tty = os.path.basename(os.path.realpath(port_inst.port))
+            latency_timer = os.path.join('/sys/bus/usb-serial/devices', tty, 'latency_timer')
+            if os.path.exists(latency_timer):
+                with open(latency_timer, 'w') as f:
+                    f.write('1')
+            # same as `setserial <port> low_latency`
+            port_inst.set_low_latency_mode(True)
+        elif sys.platform == 'darwin':
+            fcntl.ioctl(port_inst.fileno(), _IOSSDATALAT, struct.pack('L', 1))
+    except (AttributeError, OSError, ValueError):
+        # not a local serial port, or no permission to change the settings
+        pass
+
+
 def _uses_esptool(func):
     """ Suspend listener thread, connect with esptool,
     call target function with esptool instance,
     then resume listening for output
+
+    Inside ``IDFDUT.esptool_session()``, the esptool connection is kept for the next call instead.
     """
     @functools.wraps(func)
     def handler(self, *args, **kwargs):
-        self.stop_receive()
-
-        settings = self.port_inst.get_settings()
+        if self._esptool_session:
+            if self._esp_stub is None:
+                self._esp_stub = self._connect_esptool()
+            try:
+                return func(self, self._esp_stub, *args, **kwargs)
+            except Exception:
+                # the stub may be in a bad state, connect again in the next call.
+                # The port may still be at the flash baud rate, connect from the ROM loader baud rate.
+                self._esp_stub = None
+                self.port_inst.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+                raise
 
         try:
-            if not self.rom_inst:
-                if not self.secure_boot_en:
-                    self.rom_inst = esptool.ESPLoader.detect_chip(self.port_inst)
-                else:
-                    self.rom_inst = self.get_rom()(self.port_inst)
-            self.rom_inst.connect('hard_reset')
-
-            if (self.secure_boot_en):
-                esp = self.rom_inst
-                esp.flash_spi_attach(0)
-            else:
-                esp = self.rom_inst.run_stub()
-
+            esp = self._connect_esptool()
             ret = func(self, esp, *args, **kwargs)
             # do hard reset after use esptool
             esp.hard_reset()
         finally:
             # always need to restore port settings
-            self.port_inst.apply_settings(settings)
+            self._restore_port_settings()
 
         self.start_receive()
 
@@ -142,25 +177,124 @@ def _uses_esptool(func):
     return handler
 
 
+def _image_key(image):
+    return len(image), hashlib.sha256(image).digest()
+
+
+def _compress_image(image):
+    return _image_key(image), zlib.compress(image, 9)
+
+
+class _PrecompressedZlib(object):
+    """
+    Stand-in for the ``zlib`` module used by ``esptool.write_flash()``.
+
+    Images are compressed in a thread pool (zlib releases the GIL) while esptool connects to the chip and uploads
+    the stub. ``compress()`` returns the precomputed result if esptool asks for the same data, otherwise
+    (e.g. the bootloader header was updated by esptool) it compresses as usual.
+    Only the compressed images are kept, looked up by length and hash of the uncompressed data.
+    """
+
+    def __init__(self, files):
+        self._executor = concurrent.futures.ThreadPoolExecutor()
+        self._futures = []
+        for (_, f) in files:
+            image = f.read()
+            f.seek(0)
+            # esptool pads images to 4 bytes before compressing
+            if len(image) % 4:
+                image += b'\xff' * (4 - len(image) % 4)
+            self._futures.append(self._executor.submit(_compress_image, image))
+
+    def __getattr__(self, name):
+        return getattr(zlib, name)
+
+    def compress(self, data, level=-1):
+        if level == 9 and isinstance(data, bytes):
+            key = _image_key(data)
+            for future in self._futures:
+                image_key, compressed = future.result()
+                if image_key == key:
+                    return compressed
+        return zlib.compress(data, level)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+# erased (0xFF) NVS partition contents, keyed by size
+_NVS_BLOBS = dict()  # type: ignore
+
+
+# device nodes globbed instead of enumerating ports with pyserial, which also reads USB descriptors
+_PORT_GLOBS = []  # type: ignore
+if sys.platform == 'win32':
+    _PORT_PATTERN = re.compile(r'COM\d+')
+elif sys.platform == 'darwin':
+    # only the callout devices, /dev/tty.* are the same ports and Bluetooth ports slow down probing
+    _PORT_PATTERN = re.compile(r'cu\.(usb|SLAB|wch)')
+    _PORT_GLOBS = ['/dev/cu.*']
+else:
+    _PORT_PATTERN = re.compile(r'tty(USB|ACM)')
+    if sys.platform.startswith('linux'):
+        _PORT_GLOBS = ['/dev/ttyUSB*', '/dev/ttyACM*']
+
+
+def _flash_one(dut_cls, port, app, erase_nvs, dut_kwargs):
+    """ Called by IDFDUT.flash_many() in a worker process, flash one DUT with its own port and esptool instance
+
+    :param dut_kwargs: extra args the DUT was created with (serial port configs, ...)
+    :return: baud rate used for flashing
+    """
+    dut = dut_cls('flash_{}'.format(port), port, os.devnull, app, allow_dut_exception=True, **dut_kwargs)
+    try:
+        with dut.esptool_session():
+            dut.start_app(erase_nvs)
+            # don't hard reset here, the boot output would be lost.
+            # flash_many() resets the DUT once the parent process listens to the port again
+            dut._esp_stub = None
+    finally:
+        dut.close()
+    return IDFDUT._baud_cache.get(port)
+
+
 class IDFDUT(DUT.SerialDUT):
     """ IDF DUT, extends serial with esptool methods
 
     (Becomes aware of IDFApp instance which holds app-specific data)
     """
 
+    # ports which may be connected to a DUT (USB serial ports on Linux and macOS)
+    PORT_PATTERN = _PORT_PATTERN
     # /dev/ttyAMA0 port is listed in Raspberry Pi
     # /dev/tty.Bluetooth-Incoming-Port port is listed in Mac
     INVALID_PORT_PATTERN = re.compile(r'AMA|Bluetooth')
     # if need to erase NVS partition in start app
     ERASE_NVS = True
     RECV_THREAD_CLS = IDFRecvThread
+    # baud rates tried when flashing, fastest first.
+    # Faster baud rates (e.g. 2000000) aren't supported by all adapters, set $ESPBAUD to try them.
+    FLASH_BAUD_RATES = [921600, 460800, 115200]
+    # last baud rate which flashed successfully, keyed by port
+    _baud_cache = dict()  # type: ignore
+    # size of each esptool read_flash request in dump_flash
+    DUMP_FLASH_CHUNK_SIZE = 0x10000
+    # enumerating ports is slow on some hosts, reuse the result for a few seconds
+    _PORTS_TTL = 3.0
+    _ports_cache = None
+    _ports_cache_ts = 0.0
 
     def __init__(self, name, port, log_file, app, allow_dut_exception=False, **kwargs):
         super(IDFDUT, self).__init__(name, port, log_file, app, **kwargs)
+        # kept to create the same DUT in a worker process, see flash_many()
+        self._init_kwargs = kwargs
         self.allow_dut_exception = allow_dut_exception
         self.exceptions = _queue.Queue()
         self.performance_items = _queue.Queue()
         self.rom_inst = None
+        self._esptool_session = False
+        self._esp_stub = None
+        self._port_settings = None
         self.secure_boot_en = self.app.get_sdkconfig_config_value('CONFIG_SECURE_BOOT') and \
             not self.app.get_sdkconfig_config_value('CONFIG_EFUSE_VIRTUAL')
 
@@ -168,6 +302,81 @@ class IDFDUT(DUT.SerialDUT):
     def get_rom(cls):
         raise NotImplementedError('This is an abstraction class, method not defined.')
 
+    def _connect_esptool(self):
+        """
+        Suspend listener thread, connect with esptool and run the stub (unless secure boot is enabled)
+
+        :return: esptool instance
+        """
+        if self._port_settings is None:
+            self.stop_receive()
+            _set_low_latency(self.port_inst)
+            self._port_settings = self.port_inst.get_settings()
+
+        if not self.rom_inst:
+            if not self.secure_boot_en:
+                self.rom_inst = esptool.ESPLoader.detect_chip(self.port_inst)
+            else:
+                self.rom_inst = self.get_rom()(self.port_inst)
+        self.rom_inst.connect('hard_reset')
+
+        if (self.secure_boot_en):
+            esp = self.rom_inst
+            esp.flash_spi_attach(0)
+        else:
+            esp = self.rom_inst.run_stub()
+        return esp
+
+    def _reconnect_esptool(self):
+        """
+        Connect with esptool again from the ROM loader baud rate.
+        Used after a failed baud rate change, when the chip and the host may have ended up at different baud rates.
+
+        :return: esptool instance
+        """
+        self.port_inst.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        esp = self._connect_esptool()
+        if self._esptool_session:
+            self._esp_stub = esp
+        return esp
+
+    def _restore_port_settings(self):
+        if self._port_settings is not None:
+            self.port_inst.apply_settings(self._port_settings)
+            self._port_settings = None
+
+    @contextlib.contextmanager
+    def esptool_session(self):
+        """
+        Keep esptool connected while calling several esptool methods (``start_app``, ``erase_flash``, ...),
+        so connecting and uploading the stub is only done once.
+        The DUT is hard reset when leaving the context.
+        """
+        self._esptool_session = True
+        try:
+            yield
+        finally:
+            self.close_esptool_session()
+
+    def close_esptool_session(self):
+        """
+        Close the esptool connection kept by ``esptool_session()``:
+        hard reset DUT, restore port settings, then resume listening for output.
+
+        :return: None
+        """
+        self._esptool_session = False
+        if self._port_settings is None:
+            # not connected
+            return
+        try:
+            if self._esp_stub is not None:
+                self._esp_stub.hard_reset()
+        finally:
+            self._esp_stub = None
+            self._restore_port_settings()
+        self.start_receive()
+
     @classmethod
     def get_mac(cls, app, port):
         """
@@ -182,13 +391,18 @@ class IDFDUT(DUT.SerialDUT):
             esp = cls.get_rom()(port)
             esp.connect()
             return esp.read_mac()
-        except RuntimeError:
+        except (RuntimeError, OSError, serial.SerialException):
+            # serial.SerialException is raised for ports which can't be opened (busy, no permission, ...)
             return None
         finally:
-            if esp:
-                # do hard reset after use esptool
-                esp.hard_reset()
-                esp._port.close()
+            if esp is not None:
+                try:
+                    # do hard reset after use esptool
+                    esp.hard_reset()
+                except (OSError, serial.SerialException):
+                    pass
+                finally:
+                    esp._port.close()
 
     @classmethod
     def confirm_dut(cls, port, **kwargs):
@@ -205,12 +419,38 @@ class IDFDUT(DUT.SerialDUT):
             if expected_rom_class and type(inst) != expected_rom_class:
                 raise RuntimeError('Target not expected')
             return inst.read_mac() is not None, get_target_by_rom_class(type(inst))
-        except(esptool.FatalError, RuntimeError):
+        except (esptool.FatalError, RuntimeError, serial.SerialException):
+            # serial.SerialException is raised for ports which can't be opened (busy, no permission, ...)
             return False, None
         finally:
             if inst is not None:
                 inst._port.close()
 
+    def _get_flash_baud_rates(self):
+        """
+        Get the baud rates to try when flashing, in order.
+
+        $ESPBAUD (if set) is tried first, then the last baud rate that worked on this port,
+        then ``FLASH_BAUD_RATES``.
+
+        :return: list of baud rates
+        """
+        preferred = []
+        espbaud = os.getenv('ESPBAUD')
+        if espbaud:
+            try:
+                preferred.append(int(espbaud))
+            except ValueError:
+                raise ValueError('Invalid baud rate in $ESPBAUD: {!r}, it must be an integer'.format(espbaud))
+        cached = IDFDUT._baud_cache.get(self.port)
+        if cached:
+            preferred.append(cached)
+        baud_rates = []
+        for baud_rate in preferred + self.FLASH_BAUD_RATES:
+            if baud_rate not in baud_rates:
+                baud_rates.append(baud_rate)
+        return baud_rates
+
     def _try_flash(self, erase_nvs):
         """
         Called by start_app()
@@ -219,9 +459,10 @@ class IDFDUT(DUT.SerialDUT):
         """
         flash_files = []
         encrypt_files = []
+        precompressed = None
         try:
-            # Open the files here to prevents us from having to seek back to 0
-            # each time. Before opening them, we have to organize the lists the
+            # Open the files here, they're seeked back to 0 before each write.
+            # Before opening them, we have to organize the lists the
             # way esptool.write_flash needs:
             # If encrypt is provided, flash_files contains all the files to
             # flash.
@@ -241,78 +482,117 @@ class IDFDUT(DUT.SerialDUT):
             flash_files = [(offs, open(path, 'rb')) for (offs, path) in flash_files]
             encrypt_files = [(offs, open(path, 'rb')) for (offs, path) in encrypt_files]
 
+            erase_regions = []
             if erase_nvs:
                 address = self.app.partition_table['nvs']['offset']
                 size = self.app.partition_table['nvs']['size']
-                nvs_file = tempfile.TemporaryFile()
-                nvs_file.write(b'\xff' * size)
-                nvs_file.seek(0)
-                if not isinstance(address, int):
-                    address = int(address, 0)
-                # We have to check whether this file needs to be added to
+                # We have to check whether NVS needs to be erased, added to
                 # flash_files list or encrypt_files.
                 # Get the CONFIG_SECURE_FLASH_ENCRYPTION_MODE_DEVELOPMENT macro
                 # value. If it is set to True, then NVS is always encrypted.
                 sdkconfig_dict = self.app.get_sdkconfig()
                 macro_encryption = 'CONFIG_SECURE_FLASH_ENCRYPTION_MODE_DEVELOPMENT' in sdkconfig_dict
-                # If the macro is not enabled (plain text flash) or all files
-                # must be encrypted, add NVS to flash_files.
-                if not macro_encryption or encrypt:
-                    flash_files.append((address, nvs_file))
+                if not macro_encryption and not encrypt and not self.secure_boot_en:
+                    # plain text NVS is erased in write_flash_data, no need to send 0xFF over serial
+                    erase_regions.append((address, size))
                 else:
-                    encrypt_files.append((address, nvs_file))
-
-            self.write_flash_data(flash_files, encrypt_files, False, encrypt)
+                    # BytesIO doesn't copy the bytes object until it's written,
+                    # so the blob is built only once for each partition size
+                    if size not in _NVS_BLOBS:
+                        _NVS_BLOBS[size] = b'\xff' * size
+                    nvs_file = io.BytesIO(_NVS_BLOBS[size])
+                    # If the macro is not enabled (plain text flash) or all files
+                    # must be encrypted, add NVS to flash_files.
+                    if not macro_encryption or encrypt:
+                        flash_files.append((address, nvs_file))
+                    else:
+                        encrypt_files.append((address, nvs_file))
+
+            # esptool doesn't compress with the ROM loader (secure boot) or encrypted images
+            if not self.secure_boot_en and not encrypt:
+                precompressed = _PrecompressedZlib(flash_files)
+            self.write_flash_data(flash_files, encrypt_files, False, encrypt,
+                                  precompressed=precompressed, erase_regions=erase_regions)
         finally:
+            if precompressed is not None:
+                precompressed.close()
             for (_, f) in flash_files:
                 f.close()
             for (_, f) in encrypt_files:
                 f.close()
 
     @_uses_esptool
-    def write_flash_data(self, esp, flash_files=None, encrypt_files=None, ignore_flash_encryption_efuse_setting=True, encrypt=False):
+    def write_flash_data(self, esp, flash_files=None, encrypt_files=None, ignore_flash_encryption_efuse_setting=True, encrypt=False,
+                         precompressed=None, erase_regions=None):
         """
-        Try flashing at a particular baud rate.
+        Flash files at the fastest baud rate which works.
 
-        Structured this way so @_uses_esptool will reconnect each time
+        :param precompressed: ``_PrecompressedZlib`` instance, used by esptool instead of ``zlib`` to compress images
+        :param erase_regions: list of (address, size) to erase before flashing files
         :return: None
         """
+        # fake flasher args object, this is a hack until
+        # esptool Python API is improved
+        class FlashArgs(object):
+            def __init__(self, attributes):
+                for key, value in attributes.items():
+                    self.__setattr__(key, value)
+
+        # write_flash expects the parameter encrypt_files to be None and not
+        # an empty list, so perform the check here.
+        # The stub (and therefore compression) can't be used with secure boot enabled,
+        # as `_uses_esptool` talks to the ROM loader directly in that case.
+        flash_args = FlashArgs({
+            'flash_size': self.app.flash_settings['flash_size'],
+            'flash_mode': self.app.flash_settings['flash_mode'],
+            'flash_freq': self.app.flash_settings['flash_freq'],
+            'addr_filename': flash_files or None,
+            'encrypt_files': encrypt_files or None,
+            'no_stub': self.secure_boot_en,
+            'compress': not self.secure_boot_en,
+            'verify': False,
+            'encrypt': encrypt,
+            'ignore_flash_encryption_efuse_setting': ignore_flash_encryption_efuse_setting,
+            'erase_all': False,
+            'after': 'no_reset',
+        })
+
         last_error = None
-        for baud_rate in [921600, 115200]:
+        for baud_rate in self._get_flash_baud_rates():
             try:
-                # fake flasher args object, this is a hack until
-                # esptool Python API is improved
-                class FlashArgs(object):
-                    def __init__(self, attributes):
-                        for key, value in attributes.items():
-                            self.__setattr__(key, value)
-
-                # write_flash expects the parameter encrypt_files to be None and not
-                # an empty list, so perform the check here
-                flash_args = FlashArgs({
-                    'flash_size': self.app.flash_settings['flash_size'],
-                    'flash_mode': self.app.flash_settings['flash_mode'],
-                    'flash_freq': self.app.flash_settings['flash_freq'],
-                    'addr_filename': flash_files or None,
-                    'encrypt_files': encrypt_files or None,
-                    'no_stub': self.secure_boot_en,
-                    'compress': not self.secure_boot_en,
-                    'verify': False,
-                    'encrypt': encrypt,
-                    'ignore_flash_encryption_efuse_setting': ignore_flash_encryption_efuse_setting,
-                    'erase_all': False,
-                    'after': 'no_reset',
-                })
-
+                if last_error is not None:
+                    # the previous baud rate failed, the stub may already be running at it
+                    esp = self._reconnect_esptool()
                 esp.change_baud(baud_rate)
+                # the reply of change_baud is sent at the old baud rate,
+                # do a round trip to check that the link works at the new one
+                esp.flash_id()
                 esptool.detect_flash_size(esp, flash_args)
-                esptool.write_flash(esp, flash_args)
                 break
-            except RuntimeError as e:
+            except (RuntimeError, serial.SerialException) as e:
+                # the port or the chip doesn't work at this baud rate, try the next one
                 last_error = e
         else:
             raise last_error
 
+        # the round trip succeeded, the link is known to work at this baud rate, so errors while writing are not retried,
+        # otherwise the erase and the (compressed) transfer would be paid twice
+        for (address, size) in erase_regions or []:
+            # erased by the flash chip, no data needs to be sent
+            esp.erase_region(address, size)
+
+        # esptool reads from the current position, make sure the whole file is flashed
+        # even if it was read before (e.g. by a previous write_flash_data call)
+        for (_, f) in (flash_files or []) + (encrypt_files or []):
+            f.seek(0)
+        if precompressed is not None:
+            esptool.zlib = precompressed
+        try:
+            esptool.write_flash(esp, flash_args)
+        finally:
+            esptool.zlib = zlib
+        IDFDUT._baud_cache[self.port] = baud_rate
+
     def image_info(self, path_to_file):
         """
         get hash256 of app
@@ -348,6 +628,57 @@ class IDFDUT(DUT.SerialDUT):
         """
         self._try_flash(erase_nvs)
 
+    @classmethod
+    def flash_many(cls, duts, erase_nvs=ERASE_NVS, max_workers=None):
+        """
+        download and start app on several DUTs in parallel, one worker process per DUT.
+
+        The ports of the DUTs are released while flashing and reopened afterwards,
+        then the flashed DUTs are reset, so their boot output is received as with ``start_app``.
+
+        :param duts: list of DUT instances
+        :param erase_nvs: whether erase NVS partition during flash
+        :param max_workers: max number of worker processes, default is one per DUT (flashing waits for serial I/O, not CPU)
+        :return: dict of exceptions raised while flashing or reopening ports, keyed by port
+        """
+        errors = dict()
+        for dut in duts:
+            if dut._esptool_session:
+                # the esptool connection uses the port which is released below
+                dut.close_esptool_session()
+            dut.stop_receive()
+            dut._port_close()
+        try:
+            # don't fork, the log thread and receive threads of other DUTs may hold locks at fork time
+            with concurrent.futures.ProcessPoolExecutor(max_workers or max(len(duts), 1),
+                                                        mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(_flash_one, type(dut), dut.port, dut.app, erase_nvs, dut._init_kwargs): dut.port
+                           for dut in duts}
+                for future in concurrent.futures.as_completed(futures):
+                    port = futures[future]
+                    try:
+                        baud_rate = future.result()
+                    except Exception as e:
+                        errors[port] = e
+                    else:
+                        if baud_rate:
+                            IDFDUT._baud_cache[port] = baud_rate
+        finally:
+            for dut in duts:
+                # esptool instances keep the closed port object, connect again in the next esptool call
+                dut.rom_inst = None
+                dut._esp_stub = None
+                try:
+                    dut._port_open()
+                    dut.start_receive()
+                    if dut.port not in errors:
+                        # start the flashed app, the receive thread gets its boot output
+                        dut.reset()
+                except (serial.SerialException, OSError) as e:
+                    # keep reopening the other ports
+                    errors.setdefault(dut.port, e)
+        return errors
+
     def start_app_no_enc(self):
         """
         download and start app.
@@ -366,6 +697,7 @@ class IDFDUT(DUT.SerialDUT):
         """
         flash_offs_files = []
         encrypt_offs_files = []
+        precompressed = None
         try:
             if flash_files:
                 flash_offs_files = [(offs, open(path, 'rb')) for (offs, path) in flash_files]
@@ -373,8 +705,14 @@ class IDFDUT(DUT.SerialDUT):
             if encrypt_files:
                 encrypt_offs_files = [(offs, open(path, 'rb')) for (offs, path) in encrypt_files]
 
-            self.write_flash_data(flash_offs_files, encrypt_offs_files, ignore_flash_encryption_efuse_setting, encrypt)
+            # esptool doesn't compress with the ROM loader (secure boot) or encrypted images
+            if not self.secure_boot_en and not encrypt:
+                precompressed = _PrecompressedZlib(flash_offs_files)
+            self.write_flash_data(flash_offs_files, encrypt_offs_files, ignore_flash_encryption_efuse_setting, encrypt,
+                                  precompressed=precompressed)
         finally:
+            if precompressed is not None:
+                precompressed.close()
             for (_, f) in flash_offs_files:
                 f.close()
             for (_, f) in encrypt_offs_files:
@@ -391,16 +729,31 @@ class IDFDUT(DUT.SerialDUT):
         flash_files = [(offs, bootloader_path)]
         self.write_flash(flash_files)
 
-    @_uses_esptool
-    def reset(self, esp):
+    def reset(self):
         """
-        hard reset DUT
+        hard reset DUT by pulling EN low with RTS, the same way as esptool,
+        then make sure DUT output is being received.
+        There's no need to connect and upload the stub with esptool for this.
+
+        Inside ``esptool_session()``, the next esptool method connects again after the reset.
 
         :return: None
         """
-        # decorator `_use_esptool` will do reset
-        # so we don't need to do anything in this method
-        pass
+        # setting DTR again after RTS is a workaround for usbser.sys on Windows, same as in esptool
+        self.port_inst.setDTR(False)  # IO0=HIGH
+        self.port_inst.setRTS(True)  # EN=LOW, chip in reset
+        self.port_inst.setDTR(self.port_inst.dtr)
+        time.sleep(0.1)
+        self.port_inst.setRTS(False)  # EN=HIGH, chip out of reset
+        self.port_inst.setDTR(self.port_inst.dtr)
+        if self._esptool_session:
+            # the stub is gone, connect again from the ROM loader baud rate in the next esptool call.
+            # Don't listen to the port, it's still used by the esptool session
+            self._esp_stub = None
+            self.port_inst.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        elif self.receive_thread is None:
+            # listener was stopped before (e.g. by IDFFPGADUT.enable_efuses), resume it to see the output after reset
+            self.start_receive()
 
     @_uses_esptool
     def erase_partition(self, esp, partition):
@@ -445,9 +798,10 @@ class IDFDUT(DUT.SerialDUT):
         else:
             raise IDFToolError("You must specify 'partition' or ('address' and 'size') to dump flash")
 
-        content = esp.read_flash(_address, _size)
+        # read in chunks, so a large partition doesn't need to be held in memory
         with open(output_file, 'wb') as f:
-            f.write(content)
+            for offset in range(_address, _address + _size, self.DUMP_FLASH_CHUNK_SIZE):
+                f.write(esp.read_flash(offset, min(self.DUMP_FLASH_CHUNK_SIZE, _address + _size - offset)))
 
     @staticmethod
     def _sort_usb_ports(ports):
@@ -465,39 +819,86 @@ class IDFDUT(DUT.SerialDUT):
                 rest_ports.append(port)
         return usb_ports + rest_ports
 
+    @staticmethod
+    def invalidate_port_cache():
+        """
+        Drop the cached port list, so the next ``list_available_ports`` call enumerates ports again.
+        Useful after devices are plugged in or removed.
+        """
+        IDFDUT._ports_cache = None
+        IDFDUT._ports_cache_ts = 0.0
+
+    @staticmethod
+    def _list_port_devices():
+        """
+        :return: list of port device names, cached for ``_PORTS_TTL`` seconds
+        """
+        now = time.time()
+        if IDFDUT._ports_cache is None or now - IDFDUT._ports_cache_ts >= IDFDUT._PORTS_TTL:
+            if _PORT_GLOBS:
+                IDFDUT._ports_cache = tuple(sorted(port for pattern in _PORT_GLOBS for port in glob.glob(pattern)))
+            else:
+                IDFDUT._ports_cache = tuple(x.device for x in list_ports.comports())
+            IDFDUT._ports_cache_ts = now
+        return list(IDFDUT._ports_cache)
+
     @classmethod
     def list_available_ports(cls):
-        # It will return other kinds of ports as well, such as ttyS* ports.
-        # Give the usb ports higher priority
-        ports = cls._sort_usb_ports([x.device for x in list_ports.comports()])
+        """
+        List the ports which may be connected to a DUT, USB ports first.
+        If $ESPPORT is an available port, it's listed first.
+
+        If $ESPPORT is an existing device node, it's yielded without enumerating ports.
+        The other ports are only enumerated if the caller iterates past it (multi-DUT test cases).
+
+        :return: iterable of available ports (a generator, ports are enumerated lazily)
+        """
         espport = os.getenv('ESPPORT')
-        if not espport:
-            # It's a little hard filter out invalid port with `serial.tools.list_ports.grep()`:
-            # The check condition in `grep` is: `if r.search(port) or r.search(desc) or r.search(hwid)`.
-            # This means we need to make all 3 conditions fail, to filter out the port.
-            # So some part of the filters will not be straight forward to users.
-            # And negative regular expression (`^((?!aa|bb|cc).)*$`) is not easy to understand.
-            # Filter out invalid port by our own will be much simpler.
-            return [x for x in ports if not cls.INVALID_PORT_PATTERN.search(x)]
-
-        # On MacOs with python3.6: type of espport is already utf8
-        if isinstance(espport, type(u'')):
-            port_hint = espport
-        else:
-            port_hint = espport.decode('utf8')
+        # On macOS, user may set ESPPORT to /dev/tty.xxx while
+        # only the corresponding /dev/cu.xxx port is listed
+        if espport and sys.platform == 'darwin' and 'tty.' in espport and os.path.exists(espport.replace('tty.', 'cu.')):
+            espport = espport.replace('tty.', 'cu.')
+
+        if not espport or not os.path.exists(espport):
+            for port in cls._scan_available_ports(espport):
+                yield port
+            return
+
+        yield espport
+        # $ESPPORT may be a symlink (e.g. /dev/serial/by-id/xxx) to one of the listed ports
+        espport_path = os.path.realpath(espport)
+        for port in cls._scan_available_ports(None):
+            if os.path.realpath(port) != espport_path:
+                yield port
 
-        # If $ESPPORT is a valid port, make it appear first in the list
-        if port_hint in ports:
-            ports.remove(port_hint)
-            return [port_hint] + ports
+    @classmethod
+    def _scan_available_ports(cls, port_hint):
+        """
+        :param port_hint: port to put first in the list if it's available ($ESPPORT), or None
+        :return: list of available ports
+        """
+        all_ports = cls._list_port_devices()
+        # It's a little hard filter out invalid port with `serial.tools.list_ports.grep()`:
+        # The check condition in `grep` is: `if r.search(port) or r.search(desc) or r.search(hwid)`.
+        # This means we need to make all 3 conditions fail, to filter out the port.
+        # So some part of the filters will not be straight forward to users.
+        # And negative regular expression (`^((?!aa|bb|cc).)*$`) is not easy to understand.
+        # Filter by port name on our own will be much simpler.
+        # Give the usb ports higher priority
+        ports = cls._sort_usb_ports([x for x in all_ports
+                                     if cls.PORT_PATTERN.search(x) and not cls.INVALID_PORT_PATTERN.search(x)])
+        if not port_hint:
+            return ports
 
         # On macOS, user may set ESPPORT to /dev/tty.xxx while
         # pySerial lists only the corresponding /dev/cu.xxx port
-        if sys.platform == 'darwin' and 'tty.' in port_hint:
+        if sys.platform == 'darwin' and 'tty.' in port_hint and port_hint not in all_ports:
             port_hint = port_hint.replace('tty.', 'cu.')
-            if port_hint in ports:
-                ports.remove(port_hint)
-                return [port_hint] + ports
+
+        # If $ESPPORT is a valid port, make it appear first in the list,
+        # even if it doesn't look like a DUT port
+        if port_hint in all_ports:
+            return [port_hint] + [x for x in ports if x != port_hint]
 
         return ports
 
@@ -709,7 +1110,7 @@ class IDFQEMUDUT(IDFDUT):
 
     @classmethod
     def list_available_ports(cls):
-        return ['socket://localhost:{}'.format(cls.QEMU_SERIAL_PORT)]
+        yield 'socket://localhost:{}'.format(cls.QEMU_SERIAL_PORT)
 
     def close(self):
         super(IDFQEMUDUT, self).close()